@@ -2,46 +2,568 @@
 """
 iOS Simulator MCP Server
 iOSシミュレーターを制御するためのMCPサーバー（正しいMCPプロトコル実装）
+orjson がインストールされていれば JSON のエンコード/デコードに使用する（任意）
+fastjsonschema がインストールされていればツール引数を inputSchema で検証する（任意）
 """
 
 import asyncio
+import collections
+import contextlib
+import contextvars
 import json
-import subprocess
+import os
+import re
+import shlex
+import shutil
+import signal
 import sys
-from typing import Any, Dict, List, Optional
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    # 未インストール環境では標準ライブラリの json にフォールバックする
+    orjson = None
+
+try:
+    import fastjsonschema
+except ImportError:
+    # 未インストール環境では必須引数の有無のみを確認する
+    fastjsonschema = None
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    """JSONをデコード（失敗時は json.JSONDecodeError。orjson の例外もそのサブクラス）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(value: Any) -> str:
+    """JSONをエンコード（非ASCII文字はエスケープしない）"""
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False)
+
+def _json_dumps_bytes(value: Any) -> bytes:
+    """JSONを UTF-8 のバイト列へエンコード（orjson ならデコード・再エンコードを挟まない）"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+_SERVER_VERSION = "1.0.0"
+
+# ツール定義と初期化応答は不変なため、リクエストごとに組み立て直さずモジュール定数として共有する
+# （呼び出し側で変更しないこと）
+_INITIALIZE_RESULT = {
+    "protocolVersion": "2024-11-05",
+    "capabilities": {
+        "tools": {}
+    },
+    "serverInfo": {
+        "name": "ios-simulator-mcp",
+        "version": _SERVER_VERSION
+    }
+}
+
+_TOOLS = [
+    {
+        "name": "list_devices",
+        "description": "利用可能なiOSシミュレーターデバイスをリストアップ",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "filter": {
+                    "type": "object",
+                    "description": "絞り込み条件（省略時は全ランタイムの利用可能なデバイス）",
+                    "properties": {
+                        "platform": {
+                            "type": "string",
+                            "description": "ランタイムのプラットフォーム（例: 'iOS'）"
+                        },
+                        "state": {
+                            "type": "string",
+                            "description": "デバイスの状態（例: 'Booted'）"
+                        }
+                    }
+                }
+            },
+            "required": []
+        }
+    },
+    {
+        "name": "boot_device",
+        "description": "指定されたデバイスを起動",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたはデバイス名"
+                }
+            },
+            "required": ["device_id"]
+        }
+    },
+    {
+        "name": "shutdown_device",
+        "description": "指定されたデバイスをシャットダウン",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたは'booted'"
+                }
+            },
+            "required": ["device_id"]
+        }
+    },
+    {
+        "name": "install_app",
+        "description": "アプリをシミュレーターにインストール",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたは'booted'"
+                },
+                "app_path": {
+                    "type": "string",
+                    "description": ".appファイルのパス"
+                }
+            },
+            "required": ["device_id", "app_path"]
+        }
+    },
+    {
+        "name": "launch_app",
+        "description": "アプリを起動",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたは'booted'"
+                },
+                "bundle_id": {
+                    "type": "string",
+                    "description": "アプリのBundle ID"
+                }
+            },
+            "required": ["device_id", "bundle_id"]
+        }
+    },
+    {
+        "name": "build_and_run",
+        "description": "Xcodeプロジェクトをビルドしてシミュレーターで実行",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "project_path": {
+                    "type": "string",
+                    "description": "Xcodeプロジェクトのパス"
+                },
+                "scheme": {
+                    "type": "string",
+                    "description": "ビルドスキーム"
+                },
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたは'booted'",
+                    "default": "booted"
+                }
+            },
+            "required": ["project_path", "scheme"]
+        }
+    },
+    {
+        "name": "get_app_status",
+        "description": "アプリの実行状態を確認",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "デバイスのUDIDまたは'booted'"
+                },
+                "bundle_id": {
+                    "type": "string",
+                    "description": "アプリのBundle ID"
+                }
+            },
+            "required": ["device_id", "bundle_id"]
+        }
+    }
+]
+
+_LIST_TOOLS_RESULT = {"tools": _TOOLS}
+# tools/list の result 部分は事前にシリアライズしておき、応答時の JSON エンコードを省く
+_LIST_TOOLS_RESULT_JSON = _json_dumps_bytes(_LIST_TOOLS_RESULT)
+
+def encode_message(message: Any) -> bytes:
+    """JSON-RPC応答（またはバッチ応答）を1行分のJSONバイト列にエンコード（改行は含まない）"""
+    if isinstance(message, list):
+        return b"[" + b",".join(encode_message(item) for item in message) + b"]"
+    if isinstance(message, dict) and message.get("result") is _LIST_TOOLS_RESULT:
+        return (
+            b'{"jsonrpc":"2.0","id":' + _json_dumps_bytes(message.get("id")) +
+            b',"result":' + _LIST_TOOLS_RESULT_JSON + b"}"
+        )
+    return _json_dumps_bytes(message)
+
+def _text_result(text: str) -> Dict[str, Any]:
+    """テキスト1件からなるツール実行結果を生成"""
+    return {"content": [{"type": "text", "text": text}]}
+
+
+def _error_result(text: str) -> Dict[str, Any]:
+    """テキスト1件からなるツールの失敗結果を生成（JSON-RPC としては成功応答のまま isError で示す）"""
+    return {"content": [{"type": "text", "text": text}], "isError": True}
+
+# 成功時などの定型応答は毎回組み立てず共有する（呼び出し側で変更しないこと）
+_OK_BOOT = _text_result("起動成功")
+_OK_SHUTDOWN = _text_result("シャットダウン成功")
+_OK_INSTALL = _text_result("インストール成功")
+_OK_LAUNCH = _text_result("アプリ起動成功")
+_STATUS_RUNNING = _text_result("実行中")
+_STATUS_STOPPED = _text_result("停止中")
+
+_INVALID_REQUEST_RESPONSE = {
+    "jsonrpc": "2.0",
+    "id": None,
+    "error": {"code": -32600, "message": "Invalid Request"}
+}
+# 不正な入力行への応答は内容が常に同じため、エンコード済みのバイト列を使い回す
+_PARSE_ERROR_LINE = _json_dumps_bytes({
+    "jsonrpc": "2.0",
+    "id": None,
+    "error": {"code": -32700, "message": "Parse error"}
+}) + b"\n"
+
+def _command_error(result: Dict[str, Any]) -> str:
+    """run_command の失敗結果からエラー内容を取り出す（起動失敗・タイムアウト時は stderr がない）"""
+    return result.get("stderr", result.get("error", ""))
+
+# バッチ処理中のみ設定される、'booted' -> UDID の解決タスク。
+# gather で生成される各タスクは同じ dict を参照するため、N 件の呼び出しで1回の simctl 実行を共有できる
+_batch_booted_udids: contextvars.ContextVar[Optional[Dict[str, "asyncio.Task[Optional[str]]"]]] = (
+    contextvars.ContextVar("batch_booted_udids", default=None)
+)
+
+class JSONRPCError(Exception):
+    """JSON-RPC のエラーコードを伴って応答させたい例外"""
+    
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+# サブプロセス出力の1行あたりの上限。StreamReader の既定（64KiB）では長いコンパイラ出力で溢れる
+_OUTPUT_LINE_LIMIT = 1024 * 1024
+# ビルドログから拾う診断行の上限（エラーが大量に出た場合もメモリを抑える）
+_MAX_DIAGNOSTIC_LINES = 500
+# ビルド結果として返すログ末尾の行数
+_BUILD_LOG_TAIL_LINES = 200
+# "error: ..." のほか、"/path/File.swift:12:5: error: ..." 形式のコンパイラ出力にも一致させる
+_DIAGNOSTIC_LINE_PATTERN = re.compile(r"(^|: )(error|warning): ")
+
+class SimulatorShell:
+    """シミュレーター内に常駐させる sh
+
+    `simctl spawn` は起動ごとにプロセス生成と CoreSimulatorService との接続確立を伴うため、
+    読み取り専用のコマンドは常駐シェルへ流し込んでそのコストを償却する。
+    出力の終端は一意なセンチネル行で検出する
+    """
+    
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self._proc = proc
+        self._sentinel = f"__IOS_MCP_END_{uuid.uuid4().hex}__"
+        self._lock = asyncio.Lock()
+    
+    @classmethod
+    async def spawn(cls, xcrun: str, device_id: str, env: Dict[str, str]) -> "SimulatorShell":
+        proc = await asyncio.create_subprocess_exec(
+            xcrun, "simctl", "spawn", device_id, "/bin/sh",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # コマンドのエラー内容を失わないよう、stderr も同じパイプへ流してセンチネルまでの出力に含める
+            stderr=asyncio.subprocess.STDOUT,
+            env=env
+        )
+        return cls(proc)
+    
+    @property
+    def is_alive(self) -> bool:
+        return self._proc.returncode is None
+    
+    async def run(self, command: str, timeout: float = 30) -> Dict[str, Any]:
+        """コマンドを実行し、run_command と同じ形式の結果を返す（シェル異常時は例外）"""
+        async with self._lock:
+            # 出力が改行で終わらない場合もセンチネルが独立した行になるよう、直前に改行を1つ挟む
+            script = f"{command}\n__rc=$?; echo; echo {self._sentinel}$__rc\n"
+            try:
+                self._proc.stdin.write(script.encode("utf-8"))
+                await self._proc.stdin.drain()
+                stdout, returncode = await asyncio.wait_for(self._read_until_sentinel(), timeout=timeout)
+            except BaseException:
+                # 出力の途中で中断したシェルは読み取り位置が不定になるため再利用しない
+                await self.close()
+                raise
+        
+        # stdout と stderr は区別できないため、失敗時は出力全体をエラー内容として返す
+        return {
+            "success": returncode == 0,
+            "returncode": returncode,
+            "stdout": stdout,
+            "stderr": stdout if returncode != 0 else ""
+        }
+    
+    async def _read_until_sentinel(self) -> Tuple[str, int]:
+        lines = []
+        while True:
+            line = await self._proc.stdout.readline()
+            if not line:
+                raise ConnectionError("シミュレーター内のシェルが終了しました")
+            text = line.decode("utf-8", errors="replace")
+            if text.startswith(self._sentinel):
+                stdout = "".join(lines)
+                # センチネル直前に挟んだ改行を取り除く
+                return stdout[:-1] if stdout.endswith("\n") else stdout, int(text[len(self._sentinel):])
+            lines.append(text)
+    
+    async def close(self) -> None:
+        if self.is_alive:
+            self._proc.kill()
+            await self._proc.wait()
 
 class IOSSimulatorMCPServer:
     def __init__(self):
-        self.version = "1.0.0"
+        self.version = _SERVER_VERSION
         self.request_id = 0
+        self._methods = {
+            "initialize": self.initialize,
+            "tools/list": self.list_tools,
+            "tools/call": self.call_tool
+        }
+        # ツール名 -> (ハンドラ, 必須引数, 任意引数)。引数名は inputSchema と一致させる
+        self._tools = {
+            "list_devices": (self.list_devices, (), ("filter",)),
+            "boot_device": (self.boot_device, ("device_id",), ()),
+            "shutdown_device": (self.shutdown_device, ("device_id",), ()),
+            "install_app": (self.install_app, ("device_id", "app_path"), ()),
+            "launch_app": (self.launch_app, ("device_id", "bundle_id"), ()),
+            "build_and_run": (self.build_and_run, ("project_path", "scheme"), ("device_id",)),
+            "get_app_status": (self.get_app_status, ("device_id", "bundle_id"), ())
+        }
+        # inputSchema は起動時に一度だけ検証関数へコンパイルし、呼び出しごとの解釈コストを避ける
+        self._validators: Dict[str, Callable[[Any], Any]] = {}
+        if fastjsonschema is not None:
+            # スキーマの default を引数へ書き込ませず、省略時の値はハンドラ側のデフォルトに任せる
+            self._validators = {
+                tool["name"]: fastjsonschema.compile(tool["inputSchema"], use_default=False)
+                for tool in _TOOLS
+            }
+        # 呼び出しごとの PATH 探索を避けるため、起動時に実行ファイルの絶対パスを解決しておく
+        self._executables = {
+            name: shutil.which(name) or name for name in ("xcrun", "xcodebuild", "xcode-select")
+        }
+        self._command_env: Optional[Dict[str, str]] = None
+        self._command_env_lock = asyncio.Lock()
+        # 同時実行数を絞らないとバッチで xcodebuild などが大量に並行起動しメモリを使い切るため上限を設ける。
+        # CoreSimulatorService 側は処理を直列化するので、小さな上限でも待ち時間の重ね合わせには十分
+        self._command_semaphore = asyncio.Semaphore(max(1, int(os.environ.get("IOS_MCP_MAX_PAR", "4"))))
+        # 同じ DerivedData への並行ビルドは互いの成果物を壊すため、ビルドは常に1件ずつ実行する
+        self._build_semaphore = asyncio.Semaphore(1)
+        # デバイスID -> 常駐シェル。起動・終了でデバイス状態が変わったら破棄する
+        self._shells: Dict[str, SimulatorShell] = {}
+        self._shells_lock = asyncio.Lock()
+        # simctl list は CoreSimulator の起動待ちで遅いため、argv 単位で結果を短時間キャッシュする
+        self._devices_cache: Dict[Tuple[str, ...], Tuple[float, Dict[str, Any]]] = {}
+        self._devices_ttl = 30.0
+        # 破棄のたびに進める世代番号。取得中に破棄された結果をキャッシュへ書き戻さないために使う
+        self._devices_generation = 0
+        
+    async def handle_jsonrpc_batch(self, batch: List[Any]) -> Union[Dict[str, Any], List[Dict[str, Any]], None]:
+        """JSON-RPCバッチリクエストを処理"""
+        # 仕様上、空配列にはバッチではなく単一のエラーオブジェクトで応答する
+        if not batch:
+            return _INVALID_REQUEST_RESPONSE
+        
+        # バッチ内の各ツール呼び出しで 'booted' の解決結果を共有する
+        token = _batch_booted_udids.set({})
+        try:
+            return await self._dispatch_batch(batch)
+        finally:
+            _batch_booted_udids.reset(token)
+    
+    async def _dispatch_batch(self, batch: List[Any]) -> Optional[List[Dict[str, Any]]]:
+        """バッチ内のリクエストを依存関係の層ごとに並行実行"""
+        # 独自拡張（x-chain）: 各リクエストは `input_from` や引数中の {"$from": i, "path": "..."} で
+        # 同一バッチ内の先行リクエストの結果を参照できる。依存関係で層に分け、層ごとに並行実行する
+        dependencies = [self._chain_dependencies(request, index, len(batch)) for index, request in enumerate(batch)]
+        outcomes: List[Optional[Dict[str, Any]]] = [None] * len(batch)
+        pending = set()
+        for index, request in enumerate(batch):
+            if dependencies[index] is None:
+                outcomes[index] = self._chain_error(request, -32600, "Invalid Request: input_from が不正です")
+            else:
+                pending.add(index)
+        
+        completed = set(range(len(batch))) - pending
+        while pending:
+            layer = sorted(index for index in pending if dependencies[index] <= completed)
+            if not layer:
+                break
+            # gather は入力順に結果を返すため、層内の応答もバッチ内の位置に対応付けられる
+            results = await asyncio.gather(*(
+                self._run_chain_request(batch[index], dependencies[index], outcomes) for index in layer
+            ))
+            for index, result in zip(layer, results):
+                outcomes[index] = result
+            completed.update(layer)
+            pending.difference_update(layer)
+        
+        for index in pending:
+            outcomes[index] = self._chain_error(batch[index], -32600, "Invalid Request: input_from が循環しています")
+        
+        # 通知への応答は返さない。全件が通知ならバッチ応答自体を返さない
+        responses = [response for response in outcomes if response is not None]
+        return responses or None
+    
+    def _chain_dependencies(self, request: Any, index: int, batch_size: int) -> Optional[Set[int]]:
+        """バッチ内リクエストが参照する先行リクエストの位置を収集（不正な参照があれば None）"""
+        if not isinstance(request, dict):
+            return set()
+        
+        input_from = request.get("input_from", [])
+        references = [input_from] if isinstance(input_from, int) else input_from
+        if not isinstance(references, list):
+            return None
+        references = references + self._collect_chain_refs(request.get("params"))
+        
+        # bool は int のサブクラスのため明示的に除外する
+        for reference in references:
+            if not isinstance(reference, int) or isinstance(reference, bool):
+                return None
+            if reference == index or not 0 <= reference < batch_size:
+                return None
+        return set(references)
+    
+    def _collect_chain_refs(self, value: Any) -> List[Any]:
+        """引数中の {"$from": i} 参照を再帰的に収集"""
+        if isinstance(value, dict):
+            if "$from" in value:
+                return [value["$from"]]
+            return [ref for item in value.values() for ref in self._collect_chain_refs(item)]
+        if isinstance(value, list):
+            return [ref for item in value for ref in self._collect_chain_refs(item)]
+        return []
+    
+    async def _run_chain_request(
+        self,
+        request: Any,
+        dependencies: Set[int],
+        outcomes: List[Optional[Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """依存先の結果を引数へ埋め込んでからリクエストを実行"""
+        for dependency in sorted(dependencies):
+            upstream = outcomes[dependency]
+            # ツールの失敗は JSON-RPC としては成功応答で返るため、isError も失敗として扱う
+            if upstream is None or "error" in upstream or upstream.get("result", {}).get("isError"):
+                return self._chain_error(request, -32602, f"Invalid params: 依存先のリクエスト {dependency} が失敗しました")
+        
+        if not dependencies:
+            return await self.handle_jsonrpc_request(request)
+        
+        try:
+            params = self._substitute_chain_refs(request.get("params", {}), outcomes)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            return self._chain_error(request, -32602, f"Invalid params: 参照を解決できません: {e}")
+        return await self.handle_jsonrpc_request({**request, "params": params})
+    
+    def _substitute_chain_refs(self, value: Any, outcomes: List[Optional[Dict[str, Any]]]) -> Any:
+        """引数中の {"$from": i, "path": "..."} を先行リクエストの結果で置き換える"""
+        if isinstance(value, dict):
+            if "$from" in value:
+                return self._resolve_chain_path(outcomes[value["$from"]]["result"], value.get("path", ""))
+            return {key: self._substitute_chain_refs(item, outcomes) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._substitute_chain_refs(item, outcomes) for item in value]
+        return value
+    
+    def _resolve_chain_path(self, root: Any, path: str) -> Any:
+        """`content[0].text.devices["<ランタイム名>"]` 形式のパスで結果を辿る"""
+        current = root
+        # ランタイム名などドットを含むキーは ["..."] で指定する
+        for key, quoted_key, list_index in re.findall(r'([^.\["\]]+)|\["([^"]*)"\]|\[(\d+)\]', path):
+            # ツール結果は JSON をテキストとして包んでいるため、文字列に到達したら JSON として辿る
+            if isinstance(current, str):
+                current = _json_loads(current)
+            current = current[int(list_index)] if list_index else current[key or quoted_key]
+        return current
+    
+    def _chain_error(self, request: Any, code: int, message: str) -> Optional[Dict[str, Any]]:
+        """チェーン実行時のエラー応答を生成（通知には応答しない）"""
+        if isinstance(request, dict) and "id" not in request:
+            return None
+        return {
+            "jsonrpc": "2.0",
+            "id": request.get("id") if isinstance(request, dict) else None,
+            "error": {"code": code, "message": message}
+        }
+    
+    async def handle_jsonrpc_request(self, request: Any) -> Optional[Dict[str, Any]]:
+        """JSON-RPCリクエストを処理（通知の場合は None を返す）"""
+        if not isinstance(request, dict):
+            return _INVALID_REQUEST_RESPONSE
         
-    async def handle_jsonrpc_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
-        """JSON-RPCリクエストを処理"""
         method = request.get("method")
         params = request.get("params", {})
         request_id = request.get("id")
+        is_notification = "id" not in request
+        
+        # method のないオブジェクトは通知ではなく不正なリクエストとして、ディスパッチ前に弾く
+        if not isinstance(method, str):
+            if request_id is None:
+                return _INVALID_REQUEST_RESPONSE
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {"code": -32600, "message": "Invalid Request"}
+            }
+        
+        handler = self._methods.get(method)
+        if handler is None:
+            if is_notification:
+                return None
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {"code": -32601, "message": f"Method not found: {method}"}
+            }
         
         try:
-            if method == "initialize":
-                result = await self.initialize(params)
-            elif method == "tools/list":
-                result = await self.list_tools()
-            elif method == "tools/call":
-                result = await self.call_tool(params)
-            else:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {"code": -32601, "message": f"Method not found: {method}"}
-                }
-            
+            result = await handler(params)
+            if is_notification:
+                return None
             return {
                 "jsonrpc": "2.0",
                 "id": request_id,
                 "result": result
             }
             
+        except JSONRPCError as e:
+            if is_notification:
+                return None
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {"code": e.code, "message": str(e)}
+            }
         except Exception as e:
+            if is_notification:
+                return None
             return {
                 "jsonrpc": "2.0",
                 "id": request_id,
@@ -50,307 +572,651 @@ class IOSSimulatorMCPServer:
     
     async def initialize(self, params: Dict[str, Any]) -> Dict[str, Any]:
         """MCPサーバーを初期化"""
-        return {
-            "protocolVersion": "2024-11-05",
-            "capabilities": {
-                "tools": {}
-            },
-            "serverInfo": {
-                "name": "ios-simulator-mcp",
-                "version": self.version
-            }
-        }
+        return _INITIALIZE_RESULT
     
-    async def list_tools(self) -> Dict[str, Any]:
+    async def list_tools(self, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """利用可能なツールのリストを返す"""
-        tools = [
-            {
-                "name": "list_devices",
-                "description": "利用可能なiOSシミュレーターデバイスをリストアップ",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {},
-                    "required": []
-                }
-            },
-            {
-                "name": "boot_device",
-                "description": "指定されたデバイスを起動",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたはデバイス名"
-                        }
-                    },
-                    "required": ["device_id"]
-                }
-            },
-            {
-                "name": "shutdown_device",
-                "description": "指定されたデバイスをシャットダウン",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたは'booted'"
-                        }
-                    },
-                    "required": ["device_id"]
-                }
-            },
-            {
-                "name": "install_app",
-                "description": "アプリをシミュレーターにインストール",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたは'booted'"
-                        },
-                        "app_path": {
-                            "type": "string",
-                            "description": ".appファイルのパス"
-                        }
-                    },
-                    "required": ["device_id", "app_path"]
-                }
-            },
-            {
-                "name": "launch_app",
-                "description": "アプリを起動",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたは'booted'"
-                        },
-                        "bundle_id": {
-                            "type": "string",
-                            "description": "アプリのBundle ID"
-                        }
-                    },
-                    "required": ["device_id", "bundle_id"]
-                }
-            },
-            {
-                "name": "build_and_run",
-                "description": "Xcodeプロジェクトをビルドしてシミュレーターで実行",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "project_path": {
-                            "type": "string",
-                            "description": "Xcodeプロジェクトのパス"
-                        },
-                        "scheme": {
-                            "type": "string",
-                            "description": "ビルドスキーム"
-                        },
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたは'booted'",
-                            "default": "booted"
-                        }
-                    },
-                    "required": ["project_path", "scheme"]
-                }
-            },
-            {
-                "name": "get_app_status",
-                "description": "アプリの実行状態を確認",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "device_id": {
-                            "type": "string",
-                            "description": "デバイスのUDIDまたは'booted'"
-                        },
-                        "bundle_id": {
-                            "type": "string",
-                            "description": "アプリのBundle ID"
-                        }
-                    },
-                    "required": ["device_id", "bundle_id"]
-                }
-            }
-        ]
-        
-        return {"tools": tools}
+        return _LIST_TOOLS_RESULT
     
     async def call_tool(self, params: Dict[str, Any]) -> Dict[str, Any]:
         """ツールを実行"""
+        # fastjsonschema がない環境でも、型の誤りは内部エラーではなく Invalid params として返す
+        if not isinstance(params, dict):
+            raise JSONRPCError(-32602, "Invalid params: params must be an object")
         name = params.get("name")
         arguments = params.get("arguments", {})
+        if not isinstance(arguments, dict):
+            raise JSONRPCError(-32602, "Invalid params: arguments must be an object")
         
-        if name == "list_devices":
-            return await self.list_devices()
-        elif name == "boot_device":
-            return await self.boot_device(arguments["device_id"])
-        elif name == "shutdown_device":
-            return await self.shutdown_device(arguments["device_id"])
-        elif name == "install_app":
-            return await self.install_app(arguments["device_id"], arguments["app_path"])
-        elif name == "launch_app":
-            return await self.launch_app(arguments["device_id"], arguments["bundle_id"])
-        elif name == "build_and_run":
-            return await self.build_and_run(
-                arguments["project_path"], 
-                arguments["scheme"],
-                arguments.get("device_id", "booted")
-            )
-        elif name == "get_app_status":
-            return await self.get_app_status(arguments["device_id"], arguments["bundle_id"])
-        else:
-            return {"error": f"Unknown tool: {name}"}
-    
-    async def run_command(self, args: List[str]) -> Dict[str, Any]:
-        """コマンドを実行"""
+        if name not in self._tools:
+            raise JSONRPCError(-32602, f"Unknown tool: {name}")
+        handler, required_args, optional_args = self._tools[name]
+        validator = self._validators.get(name)
+        if validator is not None:
+            try:
+                validator(arguments)
+            except fastjsonschema.JsonSchemaValueException as e:
+                raise JSONRPCError(-32602, f"Invalid params: {e.message}") from e
         try:
-            result = subprocess.run(args, capture_output=True, text=True, timeout=30)
-            return {
-                "success": result.returncode == 0,
-                "returncode": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr
-            }
-        except subprocess.TimeoutExpired:
-            return {
-                "success": False,
-                "error": "Command timed out after 30 seconds"
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            positional = [arguments[key] for key in required_args]
+        except KeyError as e:
+            raise JSONRPCError(-32602, f"Invalid params: missing argument {e.args[0]}") from e
+        
+        # 任意引数は省略時にハンドラ側のデフォルト値を使わせる
+        keyword = {key: arguments[key] for key in optional_args if key in arguments}
+        return await handler(*positional, **keyword)
     
-    async def list_devices(self) -> Dict[str, Any]:
-        """デバイスリストを取得"""
-        result = await self.run_command(["xcrun", "simctl", "list", "devices", "available", "--json"])
-        if result["success"]:
+    async def run_command(
+        self,
+        args: List[str],
+        exclusive_build: bool = False,
+        tail_lines: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """コマンドを実行（exclusive_build=True ならビルド同士を直列化する）
+
+        tail_lines を指定すると出力を行単位で読み進め、stdout/stderr は末尾の tail_lines 行だけを保持する。
+        あわせて `error:` / `warning:` を含む行を diagnostics に集める
+        """
+        args = [self._executables.get(args[0], args[0]), *args[1:]]
+        env = await self.resolve_command_env()
+        build_guard = self._build_semaphore if exclusive_build else contextlib.nullcontext()
+        # 待機中もイベントループを塞がないよう、非同期サブプロセスで実行する
+        async with build_guard, self._command_semaphore:
             try:
-                devices_data = json.loads(result["stdout"])
+                proc = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=env,
+                    limit=_OUTPUT_LINE_LIMIT,
+                    # 孫プロセス（xcodebuild が起動するコンパイラ等）ごと終了できるよう独立したプロセスグループにする
+                    start_new_session=True
+                )
+            except Exception as e:
                 return {
-                    "content": [{"type": "text", "text": json.dumps(devices_data, indent=2, ensure_ascii=False)}]
+                    "success": False,
+                    "error": str(e)
                 }
-            except json.JSONDecodeError:
+            
+            diagnostics: collections.deque = collections.deque(maxlen=_MAX_DIAGNOSTIC_LINES)
+            try:
+                if tail_lines is None:
+                    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+                else:
+                    # xcodebuild のログは数MBに達するため全体を溜めず、末尾と診断行だけを残す
+                    stdout, stderr, _ = await asyncio.wait_for(asyncio.gather(
+                        self._collect_output_tail(proc.stdout, tail_lines, diagnostics),
+                        self._collect_output_tail(proc.stderr, tail_lines, diagnostics),
+                        proc.wait()
+                    ), timeout=30)
+            except asyncio.TimeoutError:
                 return {
-                    "content": [{"type": "text", "text": f"JSON解析エラー: {result['stdout']}"}]
+                    "success": False,
+                    "error": "Command timed out after 30 seconds"
                 }
-        return {
-            "content": [{"type": "text", "text": f"コマンド失敗: {result['stderr']}"}]
-        }
+            except Exception as e:
+                return {
+                    "success": False,
+                    "error": str(e)
+                }
+            finally:
+                # どの経路で抜けても子プロセスを残さないよう kill 後に回収する。
+                # 回収前にセマフォを解放すると、読み手のいない xcodebuild が残ったまま次のビルドが始まってしまう
+                if proc.returncode is None:
+                    # 孫プロセスがパイプを握ったままだと wait() が返らないため、グループ全体を終了させる
+                    with contextlib.suppress(ProcessLookupError):
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    await proc.wait()
+            
+            result = {
+                "success": proc.returncode == 0,
+                "returncode": proc.returncode,
+                "stdout": stdout.decode("utf-8", errors="replace"),
+                "stderr": stderr.decode("utf-8", errors="replace")
+            }
+            if tail_lines is not None:
+                result["diagnostics"] = list(diagnostics)
+            return result
+    
+    async def _collect_output_tail(
+        self,
+        stream: asyncio.StreamReader,
+        tail_lines: int,
+        diagnostics: collections.deque
+    ) -> bytes:
+        """ストリームを行単位で読み切り、末尾 tail_lines 行を返す（診断行は diagnostics へ追加）"""
+        tail: collections.deque = collections.deque(maxlen=tail_lines)
+        while True:
+            try:
+                line = await stream.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                # EOF。改行で終わらない最終行が残っていればそれも扱う
+                line = e.partial
+                if not line:
+                    break
+            except asyncio.LimitOverrunError as e:
+                # 上限を超える長い行は読み捨てずに上限分ずつ切り出して読み進める
+                line = await stream.read(e.consumed)
+            tail.append(line)
+            text = line.decode("utf-8", errors="replace").rstrip()
+            if _DIAGNOSTIC_LINE_PATTERN.search(text):
+                diagnostics.append(text)
+        return b"".join(tail)
+    
+    async def resolve_command_env(self) -> Dict[str, str]:
+        """DEVELOPER_DIR を固定したサブプロセス用の環境変数を返す（初回のみ xcode-select で解決）"""
+        async with self._command_env_lock:
+            if self._command_env is not None:
+                return self._command_env
+            
+            env = dict(os.environ)
+            # xcrun/xcodebuild が毎回 Developer ディレクトリを探索しないよう、一度だけ解決して渡す。
+            # 利用者が明示的に指定している場合はそれを尊重する
+            if "DEVELOPER_DIR" not in env:
+                proc = None
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        self._executables["xcode-select"], "-p",
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.DEVNULL
+                    )
+                    stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=30)
+                    developer_dir = stdout.decode("utf-8", errors="replace").strip()
+                    if proc.returncode == 0 and developer_dir:
+                        env["DEVELOPER_DIR"] = developer_dir
+                except Exception:
+                    # 解決できない場合は各コマンド側の既定の探索に任せる
+                    pass
+                finally:
+                    # タイムアウト等で抜けた場合も子プロセスを残さないよう kill 後に回収する
+                    if proc is not None and proc.returncode is None:
+                        with contextlib.suppress(ProcessLookupError):
+                            proc.kill()
+                        await proc.wait()
+            
+            self._command_env = env
+            return env
+    
+    async def run_in_simulator(self, device_id: str, command: str) -> Dict[str, Any]:
+        """読み取り専用のコマンドをシミュレーター内の常駐シェルで実行"""
+        shell = None
+        try:
+            async with self._shells_lock:
+                shell = self._shells.get(device_id)
+                if shell is None or not shell.is_alive:
+                    shell = await SimulatorShell.spawn(
+                        self._executables["xcrun"], device_id, await self.resolve_command_env()
+                    )
+                    self._shells[device_id] = shell
+            return await shell.run(command)
+        except Exception:
+            # シェルを起動できない・使えない場合（xcrun が実行できない、デバイス未起動など）は
+            # 都度起動で実行し、エラー内容もそちらで取得する
+            if shell is not None and self._shells.get(device_id) is shell:
+                del self._shells[device_id]
+            return await self.run_command(["xcrun", "simctl", "spawn", device_id, "/bin/sh", "-c", command])
+    
+    async def close_simulator_shells(self) -> None:
+        """常駐シェルをすべて終了"""
+        async with self._shells_lock:
+            shells = list(self._shells.values())
+            self._shells.clear()
+        for shell in shells:
+            await shell.close()
+    
+    async def resolve_device_id(self, device_id: str) -> str:
+        """バッチ処理中は 'booted' を起動中デバイスの UDID に一度だけ解決して使い回す
+
+        単発の呼び出しでは解決のための simctl 実行が余分になるため、そのまま返す。
+        解決できない場合も 'booted' のまま返し、エラー内容は実際のコマンドに報告させる
+        """
+        resolutions = _batch_booted_udids.get()
+        if device_id != "booted" or resolutions is None:
+            return device_id
+        
+        task = resolutions.get(device_id)
+        if task is None:
+            task = asyncio.ensure_future(self._find_booted_udid())
+            resolutions[device_id] = task
+        udid = await task
+        if udid is None:
+            # 失敗は共有せず、後続の呼び出しで再解決させる
+            if resolutions.get(device_id) is task:
+                del resolutions[device_id]
+            return device_id
+        return udid
+    
+    async def _find_booted_udid(self) -> Optional[str]:
+        result = await self.run_command(["xcrun", "simctl", "list", "devices", "booted", "--json"])
+        if not result["success"]:
+            return None
+        try:
+            devices_data = _json_loads(result["stdout"])
+        except json.JSONDecodeError:
+            return None
+        for devices in devices_data.get("devices", {}).values():
+            for device in devices:
+                if device.get("state") == "Booted" and device.get("udid"):
+                    return device["udid"]
+        return None
+    
+    def invalidate_booted_resolution(self) -> None:
+        """起動・終了でデバイス状態が変わったら、バッチ内の 'booted' の解決結果を破棄"""
+        resolutions = _batch_booted_udids.get()
+        if resolutions is not None:
+            resolutions.clear()
+    
+    def invalidate_devices_cache(self) -> None:
+        """デバイス状態を変更する操作の前後でデバイスリストのキャッシュを破棄"""
+        self._devices_cache.clear()
+        self._devices_generation += 1
+    
+    @contextlib.contextmanager
+    def device_state_change(self, affects_booted: bool = False):
+        """デバイス状態を変更するコマンドの実行区間
+
+        実行中に並行して走った list_devices や 'booted' の解決が変更前の状態を保持し得るため、
+        前後の両方で破棄する。affects_booted は起動中デバイスが変わり得るコマンドで指定する
+        """
+        self._invalidate_device_state(affects_booted)
+        try:
+            yield
+        finally:
+            self._invalidate_device_state(affects_booted)
+    
+    def _invalidate_device_state(self, affects_booted: bool) -> None:
+        self.invalidate_devices_cache()
+        if affects_booted:
+            self.invalidate_booted_resolution()
+    
+    async def list_devices(self, filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """デバイスリストを取得"""
+        if filter is not None and not isinstance(filter, dict):
+            raise JSONRPCError(-32602, "Invalid params: filter must be an object")
+        args = ("xcrun", "simctl", "list", "devices", "available", "--json")
+        cached = self._devices_cache.get(args)
+        if cached is not None:
+            timestamp, response = cached
+            if time.monotonic() - timestamp < self._devices_ttl:
+                return self._filter_devices_response(response, filter)
+        
+        generation = self._devices_generation
+        result = await self.run_command(list(args))
+        if result["success"]:
+            stdout = result["stdout"]
+            # simctl の出力は整形済みJSONのため、パースして再シリアライズせずそのまま返す。
+            # 妥当性は先頭文字だけで簡易に判定する
+            if not stdout.lstrip().startswith("{"):
+                return _error_result(f"JSON解析エラー: {stdout}")
+            response = _text_result(stdout)
+            # 失敗結果はキャッシュせず、次回呼び出しで再試行させる。
+            # キャッシュは絞り込み前の結果を保持し、条件の異なる呼び出しで共有する
+            if generation == self._devices_generation:
+                self._devices_cache[args] = (time.monotonic(), response)
+            return self._filter_devices_response(response, filter)
+        return _error_result(f"コマンド失敗: {_command_error(result)}")
+    
+    def _filter_devices_response(self, response: Dict[str, Any], filter: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """simctl のデバイスリストを条件に合うランタイム・デバイスだけに絞り込む"""
+        if not filter:
+            return response
+        
+        platform = filter.get("platform")
+        state = filter.get("state")
+        devices_data = _json_loads(response["content"][0]["text"])
+        filtered: Dict[str, List[Dict[str, Any]]] = {}
+        for runtime, devices in devices_data.get("devices", {}).items():
+            # ランタイム名は "com.apple.CoreSimulator.SimRuntime.iOS-17-0" の形式
+            if platform and not runtime.rsplit(".", 1)[-1].startswith(f"{platform}-"):
+                continue
+            matched = [
+                device for device in devices
+                if device.get("isAvailable", False) and (not state or device.get("state") == state)
+            ]
+            if matched:
+                filtered[runtime] = matched
+        
+        return _text_result(_json_dumps({"devices": filtered}))
     
     async def boot_device(self, device_id: str) -> Dict[str, Any]:
         """デバイスを起動"""
-        result = await self.run_command(["xcrun", "simctl", "boot", device_id])
-        status = "起動成功" if result["success"] else f"起動失敗: {result['stderr']}"
-        return {
-            "content": [{"type": "text", "text": status}]
-        }
+        await self.close_simulator_shells()
+        with self.device_state_change(affects_booted=True):
+            result = await self.run_command(["xcrun", "simctl", "boot", device_id])
+        if result["success"]:
+            return _OK_BOOT
+        return _error_result(f"起動失敗: {_command_error(result)}")
     
     async def shutdown_device(self, device_id: str) -> Dict[str, Any]:
         """デバイスをシャットダウン"""
-        result = await self.run_command(["xcrun", "simctl", "shutdown", device_id])
-        status = "シャットダウン成功" if result["success"] else f"シャットダウン失敗: {result['stderr']}"
-        return {
-            "content": [{"type": "text", "text": status}]
-        }
+        await self.close_simulator_shells()
+        with self.device_state_change(affects_booted=True):
+            result = await self.run_command(["xcrun", "simctl", "shutdown", device_id])
+        if result["success"]:
+            return _OK_SHUTDOWN
+        return _error_result(f"シャットダウン失敗: {_command_error(result)}")
     
     async def install_app(self, device_id: str, app_path: str) -> Dict[str, Any]:
         """アプリをインストール"""
-        result = await self.run_command(["xcrun", "simctl", "install", device_id, app_path])
-        status = "インストール成功" if result["success"] else f"インストール失敗: {result['stderr']}"
-        return {
-            "content": [{"type": "text", "text": status}]
-        }
+        device_id = await self.resolve_device_id(device_id)
+        with self.device_state_change():
+            result = await self.run_command(["xcrun", "simctl", "install", device_id, app_path])
+        if result["success"]:
+            return _OK_INSTALL
+        return _error_result(f"インストール失敗: {_command_error(result)}")
     
     async def launch_app(self, device_id: str, bundle_id: str) -> Dict[str, Any]:
         """アプリを起動"""
+        device_id = await self.resolve_device_id(device_id)
         result = await self.run_command(["xcrun", "simctl", "launch", device_id, bundle_id])
-        status = "アプリ起動成功" if result["success"] else f"アプリ起動失敗: {result['stderr']}"
-        return {
-            "content": [{"type": "text", "text": status}]
-        }
+        if result["success"]:
+            return _OK_LAUNCH
+        return _error_result(f"アプリ起動失敗: {_command_error(result)}")
     
     async def build_and_run(self, project_path: str, scheme: str, device_id: str = "booted") -> Dict[str, Any]:
         """プロジェクトをビルドしてシミュレーターで実行"""
-        # ビルド
-        build_result = await self.run_command([
-            "xcodebuild",
-            "-project", project_path,
-            "-scheme", scheme,
-            "-destination", "generic/platform=iOS Simulator",
-            "build"
-        ])
+        destination = "generic/platform=iOS Simulator"
+        # ビルド・シミュレーター起動待ち・ビルド設定取得は互いに独立しているため並行実行し、
+        # 所要時間を合計ではなく最長のものに抑える
+        with self.device_state_change(affects_booted=True):
+            build_result, boot_result, settings_result = await asyncio.gather(
+                self.run_command([
+                    "xcodebuild",
+                    "-project", project_path,
+                    "-scheme", scheme,
+                    "-destination", destination,
+                    "build"
+                ], exclusive_build=True, tail_lines=_BUILD_LOG_TAIL_LINES),
+                self.run_command(["xcrun", "simctl", "bootstatus", device_id, "-b"]),
+                self.run_command([
+                    "xcodebuild",
+                    "-project", project_path,
+                    "-scheme", scheme,
+                    "-destination", destination,
+                    "-showBuildSettings",
+                    "-json"
+                ]),
+                return_exceptions=True
+            )
         
+        if isinstance(build_result, BaseException):
+            build_result = {"success": False, "stderr": str(build_result)}
+        diagnostics = build_result.get("diagnostics", [])
+        diagnostics_content = [{"type": "text", "text": "\n".join(diagnostics)}] if diagnostics else []
         if not build_result["success"]:
             return {
-                "content": [{"type": "text", "text": f"ビルド失敗:\n{build_result['stderr']}"}]
+                "content": [
+                    {"type": "text", "text": f"ビルド失敗:\n{_command_error(build_result)}"},
+                    *diagnostics_content
+                ],
+                "isError": True
             }
         
-        # アプリを起動（Bundle IDが必要）
-        # 実際の実装では、ビルド結果からBundle IDを取得する必要があります
-        return {
-            "content": [{"type": "text", "text": f"ビルド成功:\n{build_result['stdout']}"}]
+        build_content = [
+            {"type": "text", "text": f"ビルド成功:\n{build_result['stdout']}"},
+            *diagnostics_content
+        ]
+        if isinstance(boot_result, BaseException):
+            boot_result = {"success": False, "stderr": str(boot_result)}
+        if not boot_result["success"]:
+            return {
+                "content": [
+                    *build_content,
+                    {"type": "text", "text": f"シミュレーター起動待ち失敗: {_command_error(boot_result)}"}
+                ],
+                "isError": True
+            }
+        
+        products = self._parse_build_products(settings_result)
+        if products is None:
+            return {
+                "content": [*build_content, {"type": "text", "text": "ビルド設定からアプリのパスを取得できませんでした"}],
+                "isError": True
+            }
+        
+        app_path, bundle_id = products
+        install_result = await self.install_app(device_id, app_path)
+        launch_result = await self.launch_app(device_id, bundle_id)
+        response = {
+            "content": [
+                *build_content,
+                *install_result["content"],
+                *launch_result["content"]
+            ]
         }
+        if install_result.get("isError") or launch_result.get("isError"):
+            response["isError"] = True
+        return response
+    
+    def _parse_build_products(self, settings_result: Any) -> Optional[Tuple[str, str]]:
+        """`-showBuildSettings -json` の結果から .app のパスと Bundle ID を取り出す"""
+        if isinstance(settings_result, BaseException) or not settings_result["success"]:
+            return None
+        try:
+            targets = _json_loads(settings_result["stdout"])
+        except json.JSONDecodeError:
+            return None
+        
+        # 複数ターゲットを含むスキームでは、アプリ本体（.app）を生成するターゲットを採用する
+        for target in targets:
+            settings = target.get("buildSettings", {})
+            if settings.get("WRAPPER_EXTENSION") != "app":
+                continue
+            build_dir = settings.get("TARGET_BUILD_DIR")
+            product_name = settings.get("FULL_PRODUCT_NAME")
+            bundle_id = settings.get("PRODUCT_BUNDLE_IDENTIFIER")
+            if build_dir and product_name and bundle_id:
+                return f"{build_dir}/{product_name}", bundle_id
+        return None
     
     async def get_app_status(self, device_id: str, bundle_id: str) -> Dict[str, Any]:
         """アプリの実行状態を確認"""
-        result = await self.run_command(["xcrun", "simctl", "spawn", device_id, "launchctl", "list"])
+        device_id = await self.resolve_device_id(device_id)
+        # simctl listapps / appinfo はプロセスの実行状態を含まないため、判定は launchctl の一覧で行う。
+        # 実行中アプリのラベルは "UIKitApplication:<Bundle ID>[...]" 形式なので、シミュレーター内で
+        # 該当行だけに絞り込み、数KBある一覧全体をパイプ越しに受け取らないようにする
+        label_pattern = f"*UIKitApplication:{shlex.quote(bundle_id)}\\[*"
+        # パイプラインの終了コードは while 側になり launchctl の失敗が隠れるため、先に出力を取得して
+        # 成功した場合だけ絞り込む。常駐シェルは stderr も結果に含めるので、launchctl の警告が
+        # 実行中と誤判定されないよう stderr も取り込んで絞り込み、失敗時にだけそのまま出力する
+        command = (
+            'if __out=$(launchctl list 2>&1); then printf \'%s\\n\' "$__out" | while IFS= read -r line; do '
+            f'case "$line" in {label_pattern}) echo "$line";; esac; done; '
+            'else __rc=$?; printf \'%s\\n\' "$__out"; (exit $__rc); fi'
+        )
+        result = await self.run_in_simulator(device_id, command)
         if result["success"]:
-            status = "実行中" if bundle_id in result["stdout"] else "停止中"
-        else:
-            status = f"状態確認失敗: {result['stderr']}"
+            return _STATUS_RUNNING if result["stdout"].strip() else _STATUS_STOPPED
+        return _error_result(f"状態確認失敗: {_command_error(result)}")
+
+# 1メッセージ（1行）の上限。これを超えて改行が来ない入力は破棄して Parse error を返す
+_STDIN_LINE_LIMIT = 16 * 1024 * 1024
+_STDIN_READ_SIZE = 65536
+
+class StdinMessageReader:
+    """標準入力を loop.add_reader で読み、改行区切りのメッセージごとにコールバックを呼ぶ
+
+    読み取り専用のスレッドを持たず、読み込み可能になったときだけイベントループ上で os.read する
+    """
+    
+    def __init__(self, on_message: Callable[[bytes], None], on_overflow: Callable[[], None]):
+        self._loop = asyncio.get_running_loop()
+        self._fd = sys.stdin.fileno()
+        self._on_message = on_message
+        self._on_overflow = on_overflow
+        self._buffer = bytearray()
+        # 上限超過した行の残りを次の改行まで読み捨てている間は True
+        self._discarding = False
+        self.closed = self._loop.create_future()
+    
+    def start(self) -> None:
+        try:
+            os.set_blocking(self._fd, False)
+            self._loop.add_reader(self._fd, self._on_readable)
+        except (OSError, ValueError):
+            # 通常ファイルは監視対象にできないが、読み込みでブロックしないため一括で処理する
+            os.set_blocking(self._fd, True)
+            self._feed(sys.stdin.buffer.read())
+            self._close()
+    
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._fd, _STDIN_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            # 読み込めなくなった入力は EOF と同様に扱い、main を待たせ続けない
+            data = b""
+        if not data:
+            self._loop.remove_reader(self._fd)
+            self._close()
+            return
+        self._feed(data)
+    
+    def _feed(self, data: bytes) -> None:
+        # 新しく届いた範囲だけを走査し、完結した行を先頭から切り出す
+        start = len(self._buffer)
+        self._buffer += data
+        consumed = 0
+        newline = self._buffer.find(b"\n", start)
+        while newline != -1:
+            line = bytes(self._buffer[consumed:newline])
+            consumed = newline + 1
+            if self._discarding:
+                self._discarding = False
+            else:
+                self._on_message(line)
+            newline = self._buffer.find(b"\n", consumed)
+        del self._buffer[:consumed]
         
-        return {
-            "content": [{"type": "text", "text": status}]
-        }
+        if len(self._buffer) > _STDIN_LINE_LIMIT:
+            self._buffer.clear()
+            if not self._discarding:
+                self._discarding = True
+                self._on_overflow()
+    
+    def _close(self) -> None:
+        # 末尾に改行のない最終行もメッセージとして扱う
+        if self._buffer and not self._discarding:
+            self._on_message(bytes(self._buffer))
+        self._buffer.clear()
+        if not self.closed.done():
+            self.closed.set_result(None)
+    
+    def close(self) -> None:
+        """入力の監視をやめる（中断時の後始末用。監視していない場合は何もしない）"""
+        self._loop.remove_reader(self._fd)
+
+class _BlockingStdoutWriter:
+    """標準出力がパイプでない（ファイルへのリダイレクト等）場合の StreamWriter 代替"""
+    
+    def write(self, data: bytes) -> None:
+        sys.stdout.buffer.write(data)
+    
+    async def drain(self) -> None:
+        sys.stdout.buffer.flush()
+
+def _get_blocking_modes() -> Dict[int, bool]:
+    """標準入出力のブロッキングモードを記録する
+
+    TTY では標準入出力が同じファイル記述を共有しており、非ブロッキング化は親シェルや後続の
+    プロセスにも残るため、変更前に記録して終了時に戻す
+    """
+    modes = {}
+    for stream in (sys.stdin, sys.stdout):
+        with contextlib.suppress(OSError, ValueError):
+            fd = stream.fileno()
+            modes[fd] = os.get_blocking(fd)
+    return modes
+
+def _restore_blocking_modes(modes: Dict[int, bool]) -> None:
+    for fd, blocking in modes.items():
+        with contextlib.suppress(OSError):
+            os.set_blocking(fd, blocking)
+
+async def open_stdout_writer() -> Any:
+    """標準出力を asyncio の StreamWriter として開く"""
+    loop = asyncio.get_running_loop()
+    try:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+    except ValueError:
+        return _BlockingStdoutWriter()
 
 async def main():
     """メイン関数"""
     server = IOSSimulatorMCPServer()
+    # connect_write_pipe も標準出力を非ブロッキングにするため、開く前に記録する
+    blocking_modes = _get_blocking_modes()
+    writer = await open_stdout_writer()
+    tasks: Set[asyncio.Task] = set()
     
-    # 標準入出力でJSON-RPCメッセージを処理
-    while True:
+    # 複数タスクの応答が行の途中で混ざらないよう、1メッセージ分の書き込みを排他する
+    write_lock = asyncio.Lock()
+    
+    async def send_line(data: bytes) -> None:
+        async with write_lock:
+            writer.write(data)
+            await writer.drain()
+    
+    async def send(message: Any) -> None:
+        # エンコード済みのバイト列をそのまま書き込み、改行付与のための連結コピーも避ける
+        async with write_lock:
+            writer.write(encode_message(message))
+            writer.write(b"\n")
+            await writer.drain()
+    
+    async def process_request(request: Any) -> None:
         try:
-            line = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
-            if not line:
-                break
-            
-            line = line.strip()
-            if not line:
-                continue
-            
-            try:
-                request = json.loads(line)
+            if isinstance(request, list):
+                response = await server.handle_jsonrpc_batch(request)
+            else:
                 response = await server.handle_jsonrpc_request(request)
-                print(json.dumps(response, ensure_ascii=False))
-                sys.stdout.flush()
-            except json.JSONDecodeError:
-                error_response = {
-                    "jsonrpc": "2.0",
-                    "id": None,
-                    "error": {"code": -32700, "message": "Parse error"}
-                }
-                print(json.dumps(error_response))
-                sys.stdout.flush()
-                
-        except EOFError:
-            break
+            if response is not None:
+                await send(response)
         except Exception as e:
             error_response = {
                 "jsonrpc": "2.0",
                 "id": None,
                 "error": {"code": -32603, "message": str(e)}
             }
-            print(json.dumps(error_response))
-            sys.stdout.flush()
+            await send(error_response)
+    
+    def on_message(line: bytes) -> None:
+        line = line.strip()
+        if not line:
+            return
+        # デコードは読み取りコールバック内で済ませ、不正な行はディスパッチに入れず定数バイト列を返すだけにする。
+        # 標準 json は不正な UTF-8 で UnicodeDecodeError を送出するため、共通の基底である ValueError で受ける
+        try:
+            request = _json_loads(line)
+        except ValueError:
+            schedule(send_line(_PARSE_ERROR_LINE))
+            return
+        schedule(process_request(request))
+    
+    def schedule(coroutine: Awaitable[None]) -> None:
+        # 各メッセージを独立したタスクで処理し、長いコマンドの完了を待たずに次の行を受け付ける
+        task = asyncio.ensure_future(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    # 標準入出力でJSON-RPCメッセージを処理
+    reader = StdinMessageReader(
+        on_message=on_message,
+        on_overflow=lambda: schedule(send_line(_PARSE_ERROR_LINE))
+    )
+    reader.start()
+    try:
+        await reader.closed
+        # 入力終了後も、処理中のリクエストには応答してから終了する
+        while tasks:
+            await asyncio.gather(*tasks)
+        
+        await server.close_simulator_shells()
+    finally:
+        reader.close()
+        _restore_blocking_modes(blocking_modes)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())